@@ -0,0 +1,62 @@
+"""
+Benchmark of the import time of the segwrap modules, before and after heavy
+dependencies (CellPose, torch, matplotlib, cv2, tqdm) were imported lazily.
+
+Each import is timed in a fresh Python interpreter. 'Before' imports the
+dependencies that the module imported at load time in segwrap 0.3.3, 'after'
+imports the current module. Also lists which heavy dependencies are loaded.
+
+Usage (from the project root):  python benchmarks/import_time.py [n_repeats]
+"""
+
+import statistics
+import subprocess
+import sys
+
+# (module, imports of the module at load time in segwrap 0.3.3)
+MODULES = [('segwrap.utils_masks', 'import numpy, scipy.ndimage, tqdm, cellpose.io'),
+           ('segwrap.utils_segmentation', 'import cellpose.io'),
+           ('segwrap.utils_cellpose', 'import numpy, tqdm, matplotlib.pyplot, cv2, cellpose.models, cellpose.io, cellpose.plot')]
+
+HEAVY = ['cellpose', 'torch', 'matplotlib', 'cv2', 'tqdm']
+
+CODE = """
+import sys, time
+t_start = time.perf_counter()
+{statement}
+t_import = time.perf_counter() - t_start
+heavy = [name for name in {heavy} if name in sys.modules]
+print(t_import, ','.join(heavy))
+"""
+
+
+def time_import(statement, n_repeats):
+    """ Time import statement in fresh interpreters, returns median time and loaded heavy modules."""
+    times = []
+    heavy = ''
+    for _ in range(n_repeats):
+        result = subprocess.run([sys.executable, '-c', CODE.format(statement=statement, heavy=HEAVY)],
+                                capture_output=True, text=True)
+        if result.returncode != 0:
+            return None, result.stderr.strip().splitlines()[-1]
+        # Last line: CellPose logs to stdout when imported
+        t_import, _, heavy = result.stdout.strip().splitlines()[-1].partition(' ')
+        times.append(float(t_import))
+    return statistics.median(times), heavy
+
+
+if __name__ == '__main__':
+
+    n_repeats = int(sys.argv[1]) if len(sys.argv) > 1 else 5
+
+    print(f'{"Module":30s} {"Before [s]":>10s} {"After [s]":>10s} {"Speed-up":>9s}   Heavy modules loaded (after)')
+    for module, statement_before in MODULES:
+        t_before, heavy_before = time_import(statement_before, n_repeats)
+        t_after, heavy_after = time_import(f'import {module}', n_repeats)
+
+        if t_after is None:
+            print(f'{module:30s} failed: {heavy_after}')
+        elif t_before is None:
+            print(f'{module:30s} {"n/a":>10s} {t_after:10.3f} {"n/a":>9s}   {heavy_after}   (before failed: {heavy_before})')
+        else:
+            print(f'{module:30s} {t_before:10.3f} {t_after:10.3f} {t_before / t_after:8.1f}x   {heavy_after}')
@@ -0,0 +1,178 @@
+# Imports
+import hashlib
+import json
+import os
+import pathlib
+import tempfile
+import time
+import zipfile
+
+import numpy as np
+
+from segwrap.utils_general import log_message
+
+
+class MaskCache:
+    """ On-disk cache for results of CellPose predictions (masks, flows, diameters).
+
+    Results are stored under a key computed from the content of the input image and all parameters
+    of the prediction, identical requests hence return stored results without running the model. The
+    cache can be shared between processes and users: entries are written to a temporary file and
+    then atomically renamed, and readers treat missing or incomplete entries as misses. When the
+    total size exceeds max_size, least recently used entries are removed. Entries and folders are
+    created readable by all, folders writable by the group.
+
+    Parameters
+    ----------
+    path_cache : pathlib Path object or str
+        Folder to store cached results.
+    max_size : int
+        Maximum size of the cache in bytes, by default 10 GB.
+    callback_log : callback, optional
+        Callback function to provide function log. If none, print will be used.
+    """
+
+    # Permissions of cache entries and folders: readable by all, folders writable by the group,
+    # so that users sharing a group can add and remove entries
+    mode_file = 0o664
+    mode_folder = 0o2775
+
+    # Number of writes after which the size of the cache is determined again from the disk
+    n_puts_scan = 100
+
+    # Fraction of max_size the cache is reduced to when evicting, so that not every write
+    # of a full cache requires a scan
+    size_evict = 0.9
+
+    def __init__(self, path_cache, max_size=10*1024**3, callback_log=None):
+        self.path_cache = pathlib.Path(path_cache)
+        self.max_size = max_size
+        self.callback_log = callback_log
+        self.hits = 0
+        self.misses = 0
+
+        if not self.path_cache.is_dir():
+            self._mkdir(self.path_cache)
+
+        # Size of the cache, estimated from the disk and updated on each write
+        self.size = 0
+        self.n_puts = 0
+        self.evict()
+
+    def key(self, img, params):
+        """ Key of an image: hash of image content and all parameters of the prediction."""
+        img = np.ascontiguousarray(img)
+        hash_key = hashlib.sha256()
+        hash_key.update(json.dumps({'shape': img.shape, 'dtype': str(img.dtype), 'params': params},
+                                   sort_keys=True, default=str).encode())
+        hash_key.update(img.tobytes())
+        return hash_key.hexdigest()
+
+    def _file(self, key):
+        return self.path_cache / key[:2] / f'{key}.npz'
+
+    def get(self, key):
+        """ Return cached result (dict of np arrays) or None if not cached."""
+        file_cache = self._file(key)
+        try:
+            with np.load(str(file_cache)) as data:
+                result = {name: data[name] for name in data.files}
+        except (FileNotFoundError, OSError, ValueError, zipfile.BadZipFile):
+            self.misses += 1
+            return None
+
+        # Mark as recently used
+        try:
+            os.utime(str(file_cache))
+        except OSError:
+            pass
+
+        self.hits += 1
+        return result
+
+    def put(self, key, result):
+        """ Store result (dict of np arrays), then evict least recently used entries if necessary.
+        Failures to write (e.g. missing permissions) are logged, the result is then not cached."""
+        file_cache = self._file(key)
+        file_tmp = None
+        try:
+            if not file_cache.parent.is_dir():
+                self._mkdir(file_cache.parent)
+
+            fd, file_tmp = tempfile.mkstemp(dir=str(file_cache.parent), suffix='.tmp')
+            with os.fdopen(fd, 'wb') as fp:
+                np.savez_compressed(fp, **result)
+            os.chmod(file_tmp, self.mode_file)
+            size = os.path.getsize(file_tmp)
+            os.replace(file_tmp, str(file_cache))
+
+        except OSError as err:
+            log_message(f' Could not write to mask cache ({self.path_cache}): {err}', callback_fun=self.callback_log)
+            if file_tmp is not None:
+                self._remove(pathlib.Path(file_tmp))
+            return
+
+        except BaseException:
+            if file_tmp is not None:
+                self._remove(pathlib.Path(file_tmp))
+            raise
+
+        # Full scan only if estimated size exceeds maximum, or to account for writes of other processes
+        self.size += size
+        self.n_puts += 1
+        if self.size > self.max_size or self.n_puts % self.n_puts_scan == 0:
+            self.evict()
+
+    def evict(self):
+        """ If the cache is larger than max_size, remove least recently used entries until it is smaller
+        than size_evict * max_size. Updates the estimated size of the cache. Also removes temporary files of interrupted writes older
+        than one hour."""
+        entries = []
+        for file_cache in self.path_cache.glob('*/*'):
+            try:
+                stat = file_cache.stat()
+            except OSError:
+                continue
+
+            if file_cache.suffix == '.tmp':
+                if time.time() - stat.st_mtime > 3600:
+                    self._remove(file_cache)
+                continue
+
+            entries.append((stat.st_mtime, stat.st_size, file_cache))
+
+        size_total = sum(entry[1] for entry in entries)
+        size_target = self.max_size if size_total <= self.max_size else self.size_evict * self.max_size
+        for mtime, size, file_cache in sorted(entries):
+            if size_total <= size_target:
+                break
+            if self._remove(file_cache):
+                size_total -= size
+
+        self.size = size_total
+
+    def _mkdir(self, path_folder):
+        """ Create folder writable by the group (permissions of mkdir are restricted by the umask)."""
+        path_folder.mkdir(parents=True, exist_ok=True)
+        try:
+            os.chmod(str(path_folder), self.mode_folder)
+        except OSError:
+            # Folder created by another user
+            pass
+
+    def _remove(self, file_cache):
+        """ Remove file, return True if the file does not exist anymore. Failures are logged."""
+        try:
+            file_cache.unlink()
+        except FileNotFoundError:
+            pass
+        except OSError as err:
+            log_message(f' Could not remove {file_cache} from mask cache: {err}', callback_fun=self.callback_log)
+            return False
+        return True
+
+    def log_stats(self):
+        """ Log number of cache hits and misses."""
+        n_total = self.hits + self.misses
+        hit_rate = 100 * self.hits / n_total if n_total > 0 else 0
+        log_message(f' Mask cache ({self.path_cache}): {self.hits} hits, {self.misses} misses ({hit_rate:.0f}% hit rate)', callback_fun=self.callback_log)
@@ -1,16 +1,191 @@
 # Imports 
 import numpy as np
-from tqdm import tqdm
 import time
-import matplotlib.pyplot as plt
 import pathlib
 from pathlib import Path
 import json
-import cv2
+from functools import lru_cache
 
-# Imports of CellPose specific libraries
-from cellpose import models, io, plot
+# CellPose (and torch), matplotlib, cv2 and tqdm are imported in the functions using them,
+# importing this module is hence fast.
 from segwrap.utils_general import log_message, create_output_path
+from segwrap.utils_io import imread, imsave
+from segwrap.utils_cache import MaskCache
+from segwrap.utils_masks import stitch_masks_3d, postprocess_mask, relabel_sequential, save_cells_nuclei_matching
+
+
+@lru_cache(maxsize=4)
+def get_model(model_type):
+    """ Load CellPose model. Models are cached, and only loaded once per model type."""
+    from cellpose import models
+    return models.Cellpose(gpu=False, model_type=model_type)  # model_type can be 'cyto' or 'nuclei'
+
+
+def image_flow_error(mask, dP):
+    """ Mean flow error of an image: difference between the flows predicted by the network, and the
+    flows recomputed from the obtained masks.
+
+    Without resampling, CellPose returns flows at the rescaled (diameter-normalised) size, while masks
+    are at the image size. The mask is then resized to the size of the flows (nearest neighbour).
+    Returns None if the flow error can not be calculated, e.g. no object remains after resizing.
+    """
+    from cellpose import metrics
+
+    if dP.shape[1:] != mask.shape:
+        ind_rows = (np.arange(dP.shape[1]) * mask.shape[0] / dP.shape[1]).astype(int)
+        ind_cols = (np.arange(dP.shape[2]) * mask.shape[1] / dP.shape[2]).astype(int)
+        mask = relabel_sequential(mask[np.ix_(ind_rows, ind_cols)])
+
+    if mask.max() == 0:
+        return None
+
+    flow_errors, _ = metrics.flow_error(mask, dP)
+    if flow_errors is None or not np.any(np.isfinite(flow_errors)):
+        return None
+    return float(np.nanmean(flow_errors))
+
+
+def model_eval(imgs, config, channels, img_names, callback_log=None):
+    """ Run CellPose model on a list of images.
+
+    If config['cache'] is a MaskCache (see utils_cache), results of images that were already
+    segmented with identical parameters are loaded from the cache, and only the remaining
+    images are segmented.
+
+    If config['net_avg'] is 'adaptive', images are first segmented with a single network. Only images
+    without objects, or with a mean flow error above config['adaptive_threshold'] (default 0.2), are
+    segmented again with the average of the 4 built-in networks.
+
+    Parameters
+    ----------
+    imgs : list of np arrays
+        Images to segment.
+    config : dict
+        Configuration of CellPose prediction.
+    channels : list
+        Channels used by CellPose.
+    img_names : list of str
+        Names of the images, used to record decisions of the adaptive mode.
+
+    Returns
+    -------
+    tuple
+        masks, flows as returned by CellPose, a list with the diameter of each image, and a
+        list with the decision of the adaptive mode for each image (empty list if not used).
+    """
+    cache = config.get('cache', None)
+    if cache is None:
+        return _model_eval(imgs, config, channels, img_names, callback_log=callback_log)
+
+    # All parameters affecting the prediction
+    params = {'model_type': config['model_type'],
+              'diameter': config['diameter'],
+              'net_avg': config['net_avg'],
+              'resample': config['resample'],
+              'channels': channels,
+              'cellpose_version': _cellpose_version()}
+    if config['net_avg'] == 'adaptive':
+        params['adaptive_threshold'] = config.get('adaptive_threshold', 0.2)
+
+    keys = [cache.key(img, params) for img in imgs]
+    results = [cache.get(key) for key in keys]
+    ind_miss = [idx for idx, result in enumerate(results) if result is None]
+    log_message(f' Mask cache: {len(imgs) - len(ind_miss)} of {len(imgs)} images found in cache', callback_fun=callback_log)
+
+    # Segment images not in the cache
+    if ind_miss:
+        masks_miss, flows_miss, diams_miss, decisions_miss = _model_eval([imgs[idx] for idx in ind_miss], config, channels,
+                                                                          [img_names[idx] for idx in ind_miss], callback_log=callback_log)
+        for idx_miss, idx in enumerate(ind_miss):
+            decision = decisions_miss[idx_miss] if decisions_miss else {}
+            results[idx] = {'mask': masks_miss[idx_miss],
+                            'flow': flows_miss[idx_miss][0],
+                            'dP': flows_miss[idx_miss][1],
+                            'cellprob': flows_miss[idx_miss][2],
+                            'diam': np.asarray(diams_miss[idx_miss]),
+                            'decision': np.asarray(json.dumps(decision))}
+            cache.put(keys[idx], results[idx])
+
+    masks = [result['mask'] for result in results]
+    flows = [[result['flow'], result['dP'], result['cellprob']] for result in results]
+    diams = [result['diam'] for result in results]
+
+    decisions = []
+    if config['net_avg'] == 'adaptive':
+        for img_name, result in zip(img_names, results):
+            decision = json.loads(str(result['decision']))
+            decision['img_name'] = str(img_name)
+            decisions.append(decision)
+
+    return masks, flows, diams, decisions
+
+
+def _cellpose_version():
+    """ Installed version of CellPose, part of the cache key."""
+    from importlib import metadata
+    try:
+        return metadata.version('cellpose')
+    except metadata.PackageNotFoundError:
+        return 'unknown'
+
+
+def _model_eval(imgs, config, channels, img_names, callback_log=None):
+    """ Run CellPose model on a list of images, see model_eval."""
+    model = get_model(config['model_type'])
+    net_avg = config['net_avg']
+    kwargs_eval = {'diameter': config['diameter'],
+                   'channels': channels,
+                   'resample': config['resample']}
+
+    if net_avg != 'adaptive':
+        masks, flows, styles, diams = model.eval(imgs, net_avg=net_avg, **kwargs_eval)
+        return masks, flows, _diams_per_image(diams, len(imgs)), []
+
+    # Single network first
+    masks, flows, styles, diams = model.eval(imgs, net_avg=False, **kwargs_eval)
+    masks, flows, diams = list(masks), list(flows), _diams_per_image(diams, len(imgs))
+
+    adaptive_threshold = config.get('adaptive_threshold', 0.2)
+    decisions = []
+    for idx, img_name in enumerate(img_names):
+        n_objects = int(masks[idx].max())
+        flow_error = image_flow_error(masks[idx], flows[idx][1]) if n_objects > 0 else None
+
+        if n_objects == 0:
+            reason = 'no_objects'
+        elif flow_error is None:
+            reason = 'flow_error_unavailable'
+        elif flow_error > adaptive_threshold:
+            reason = 'flow_error_above_threshold'
+        else:
+            reason = None
+
+        decisions.append({'img_name': str(img_name),
+                          'n_objects': n_objects,
+                          'flow_error': flow_error,
+                          'net_avg': reason is not None,
+                          'reason': reason})
+
+    # Ensemble of networks for low-confidence images
+    ind_rerun = [idx for idx, decision in enumerate(decisions) if decision['net_avg']]
+    log_message(f' Adaptive net_avg: {len(ind_rerun)} of {len(imgs)} images re-segmented with net_avg', callback_fun=callback_log)
+
+    if ind_rerun:
+        masks_avg, flows_avg, styles_avg, diams_avg = model.eval([imgs[idx] for idx in ind_rerun], net_avg=True, **kwargs_eval)
+        diams_avg = _diams_per_image(diams_avg, len(ind_rerun))
+        for idx_avg, idx in enumerate(ind_rerun):
+            masks[idx] = masks_avg[idx_avg]
+            flows[idx] = flows_avg[idx_avg]
+            diams[idx] = diams_avg[idx_avg]
+
+    return masks, flows, diams, decisions
+
+
+def _diams_per_image(diams, n_imgs):
+    """ Diameter of each image. CellPose returns a scalar if the diameter was specified, and one
+    estimated diameter per image otherwise."""
+    return np.broadcast_to(np.asarray(diams, dtype=float), (n_imgs,)).tolist()
+
 
 # Call predict function
 def cellpose_predict(data, config, path_save, callback_log=None):
@@ -24,6 +199,12 @@ def cellpose_predict(data, config, path_save, callback_log=None):
         Configuration of CellPose prediction. 
     path_save : pathline Path object
         Path where results will be saved. 
+
+    Returns
+    -------
+    dict
+        'masks' : list with predicted masks (post-processed and resized to the original size).
+        'net_avg' : list with decision of adaptive net_avg for each image (see model_eval).
     """
 
     # Get data
@@ -35,10 +216,11 @@ def cellpose_predict(data, config, path_save, callback_log=None):
     new_size = data['new_size']
     
     # Get config
-    model_type = config['model_type']
-    diameter = config['diameter']
-    net_avg = config['net_avg']
-    resample = config['resample']   
+    postprocess = config.get('postprocess', None)
+
+    from tqdm import tqdm
+    import matplotlib.pyplot as plt
+    from cellpose import plot
 
     log_message(f'\nPerforming segmentation of {obj_name}\n', callback_fun=callback_log)
 
@@ -48,12 +230,12 @@ def cellpose_predict(data, config, path_save, callback_log=None):
         path_save.mkdir()
 
     # Perform segmentation with CellPose
-    model = models.Cellpose(gpu=False, model_type=model_type)  # model_type can be 'cyto' or 'nuclei'
-    masks, flows, styles, diams = model.eval(imgs, diameter=diameter, channels=channels, net_avg=net_avg, resample=resample)
+    masks, flows, diams, decisions = model_eval(imgs, config, channels, [file_name.name for file_name in file_names], callback_log=callback_log)
 
     # Display and save results
     log_message(f'\n Creating outputs ...\n', callback_fun=callback_log)
     n_img = len(imgs)
+    masks_save = []
 
     for idx in tqdm(range(n_img)):
         
@@ -62,6 +244,10 @@ def cellpose_predict(data, config, path_save, callback_log=None):
         maski = masks[idx]
         flowi = flows[idx][0]
         imgi = imgs[idx]
+
+        # Post-process mask before saving and resizing
+        if postprocess:
+            maski = postprocess_mask(maski, **postprocess)
         
         # Rescale each channel separately
         imgi_norm = imgi.copy()
@@ -76,17 +262,19 @@ def cellpose_predict(data, config, path_save, callback_log=None):
                 imgi_norm[:, :, idim] = 255 * (imgdum - pa) / (pb - pa)
 
         # Save flow
-        io.imsave(str(path_save / f'{file_name.stem}__flow__{obj_name}.png'), flowi)
+        imsave(str(path_save / f'{file_name.stem}__flow__{obj_name}.png'), flowi)
 
         # Resize masks if necessary 
         if new_size:
             mask_full = resize_mask(maski, sizes_orginal[idx])
 
-            io.imsave(str(path_save / f'{file_name.stem}__mask__{obj_name}.png'), mask_full)
-            io.imsave(str(path_save / f'{file_name.stem}__mask_resize__{obj_name}.png'), maski)
+            imsave(str(path_save / f'{file_name.stem}__mask__{obj_name}.png'), mask_full)
+            imsave(str(path_save / f'{file_name.stem}__mask_resize__{obj_name}.png'), maski)
+            masks_save.append(mask_full)
 
         else:
-            io.imsave(str(path_save / f'{file_name.stem}__mask__{obj_name}.png'), maski)
+            imsave(str(path_save / f'{file_name.stem}__mask__{obj_name}.png'), maski)
+            masks_save.append(maski)
 
         # Save mask and flow images
         #f_mask = str(path_save / f'{file_name.stem}__mask__{obj_name}.png')
@@ -104,6 +292,84 @@ def cellpose_predict(data, config, path_save, callback_log=None):
 
     log_message(f"\nSegmentation of provided images finished ({(time.time() - start_time)}s)", callback_fun=callback_log)
 
+    return {'masks': masks_save, 'net_avg': decisions}
+
+
+# Call predict function for z-stacks
+def cellpose_predict_stack(data, config, path_save, callback_log=None):
+    """ Perform prediction with CellPose on all planes of a z-stack, and stitch
+    the obtained 2D masks to one 3D label image.
+
+    Parameters
+    ----------
+    data : dict
+        Contains data on which prediction should be performed.
+        'imgs' is a list with the (3 channel) z-planes of ONE stack.
+    config : dict
+        Configuration of CellPose prediction.
+    path_save : pathline Path object
+        Path where results will be saved.
+
+    Returns
+    -------
+    dict
+        'masks' : 3D label image (before resizing).
+        'net_avg' : list with decision of adaptive net_avg for each z-plane (see model_eval).
+    """
+
+    # Get data
+    imgs = data['imgs']
+    file_name = data['file_name']
+    channels = data['channels']
+    obj_name = data['obj_name']
+    size_orginal = data['size_orginal']
+    new_size = data['new_size']
+
+    # Get config
+    stitch_threshold = config['stitch_threshold']
+    postprocess = config.get('postprocess', None)
+
+    log_message(f'\nPerforming segmentation of {obj_name} in {len(imgs)} z-planes\n', callback_fun=callback_log)
+
+    start_time = time.time()
+
+    if not path_save.is_dir():
+        path_save.mkdir()
+
+    # Perform segmentation with CellPose: all planes in one call
+    img_names = [f'{file_name.name}_Z{str(i+1).zfill(3)}' for i in range(len(imgs))]
+    masks, flows, diams, decisions = model_eval(imgs, config, channels, img_names, callback_log=callback_log)
+
+    # Post-process masks of each plane before stitching
+    if postprocess:
+        masks = [postprocess_mask(maski, **postprocess) for maski in masks]
+
+    # Stitch masks along z
+    log_message(f'\n Stitching masks along z ...\n', callback_fun=callback_log)
+    masks_3d = stitch_masks_3d(masks, stitch_threshold=stitch_threshold)
+    n_objs = masks_3d.max()
+    log_message(f' Found {n_objs} objects in 3D', callback_fun=callback_log)
+
+    dtype_mask = 'uint16' if n_objs < 2**16 else 'uint32'
+
+    # Save flow
+    flows_3d = np.stack([flow[0] for flow in flows])
+    imsave(str(path_save / f'{file_name.stem}__flow__{obj_name}.tif'), flows_3d)
+
+    # Resize masks if necessary
+    if new_size:
+        masks_full = np.stack([resize_mask(maski, size_orginal, dtype=dtype_mask) for maski in masks_3d])
+
+        imsave(str(path_save / f'{file_name.stem}__mask__{obj_name}.tif'), masks_full)
+        imsave(str(path_save / f'{file_name.stem}__mask_resize__{obj_name}.tif'), masks_3d.astype(dtype_mask))
+
+    else:
+        imsave(str(path_save / f'{file_name.stem}__mask__{obj_name}.tif'), masks_3d.astype(dtype_mask))
+
+    log_message(f"\nSegmentation of z-stack finished ({(time.time() - start_time)}s)", callback_fun=callback_log)
+
+    return {'masks': masks_3d, 'net_avg': decisions}
+
 
 def clean_par_dict(par_dict):
     """
@@ -115,11 +381,13 @@ def clean_par_dict(par_dict):
     par_dict['callback_log'] = str(par_dict['callback_log'])
     par_dict['callback_progress'] = str(par_dict['callback_progress'])
     par_dict['callback_status'] = str(par_dict['callback_status'])
+    if 'cache_dir' in par_dict:
+        par_dict['cache_dir'] = str(par_dict['cache_dir'])
     return par_dict
 
 
 # Function to load and segment objects individually 
-def segment_obj_indiv(path_scan, obj_name, str_channel, img_ext, new_size, model_type, diameter, net_avg, resample, path_save,  input_subfolder=None, callback_log=None, callback_status=None, callback_progress=None):
+def segment_obj_indiv(path_scan, obj_name, str_channel, img_ext, new_size, model_type, diameter, net_avg, resample, path_save,  input_subfolder=None, postprocess=None, adaptive_threshold=0.2, cache_dir=None, cache_size_gb=10, callback_log=None, callback_status=None, callback_progress=None):
     """ Will recursively search folder for images to be analyzed!
 
     Parameters
@@ -140,6 +408,20 @@ def segment_obj_indiv(path_scan, obj_name, str_channel, img_ext, new_size, model
         - If 'string' a replacement operation on the provided name of the data path will be applied (see create_output_path).
     input_subfolder : str
         Name of subfolder that contains results. If specified ONLY files in this folder will be processed.
+    postprocess : dict, optional
+        Parameters for post-processing of the masks (see utils_masks.postprocess_mask), e.g.
+        {'min_size': 50, 'remove_border': True, 'fill_holes': True}. Applied before masks are saved
+        and resized. By default None, no post-processing.
+    adaptive_threshold : float, optional
+        Only used if net_avg is 'adaptive': images with a mean flow error above this threshold (or without objects)
+        are segmented again with net_avg (see model_eval). Decisions for each image are saved in the
+        segmentation settings. By default 0.2.
+    cache_dir : pathlib Path object or str, optional
+        Folder of an on-disk cache of CellPose results (see utils_cache.MaskCache). Images already segmented with
+        identical parameters are loaded from the cache instead of being segmented again. Can be shared between
+        users and processes. By default None, no cache.
+    cache_size_gb : float, optional
+        Maximum size of the cache in GB, least recently used results are removed. By default 10.
     callback_log : [type], optional
         [description], by default None
     callback_status : [type], optional
@@ -157,12 +439,18 @@ def segment_obj_indiv(path_scan, obj_name, str_channel, img_ext, new_size, model
     par_dict = locals()
     par_dict = clean_par_dict(par_dict)
     log_message(f"Function (segment_obj_indiv) called with: {str(par_dict)} ", callback_fun=callback_log)
+    par_dict['net_avg_decisions'] = []
+
+    cache = MaskCache(cache_dir, max_size=cache_size_gb*1024**3, callback_log=callback_log) if cache_dir else None
 
     # Configurations
     config = {'model_type': model_type,
               'diameter': diameter,
               'net_avg': net_avg,
-              'resample': resample}
+              'resample': resample,
+              'postprocess': postprocess,
+              'adaptive_threshold': adaptive_threshold,
+              'cache': cache}
 
     channels = [0, 1]
 
@@ -210,7 +498,7 @@ def segment_obj_indiv(path_scan, obj_name, str_channel, img_ext, new_size, model
             callback_progress(progress)
 
         # Read images
-        img = io.imread(str(path_img))
+        img = imread(str(path_img))
         if img.ndim != 2:
             log_message(f'\nERROR\n  Input image has to be 2D. Current image is {img.ndim}D', callback_fun=callback_log)
             continue
@@ -224,6 +512,7 @@ def segment_obj_indiv(path_scan, obj_name, str_channel, img_ext, new_size, model
 
         # Resize
         if new_size:
+            import cv2
 
             # New size can also be defined as a scalar factor
             if len(new_size) == 1:
@@ -257,7 +546,8 @@ def segment_obj_indiv(path_scan, obj_name, str_channel, img_ext, new_size, model
             path_save_results = create_output_path(path_img.parent, path_save_str_replace, subfolder='', create_path=True)
             path_save_settings = path_save_results
 
-        cellpose_predict(data, config, path_save=path_save_results, callback_log=callback_log)
+        results = cellpose_predict(data, config, path_save=path_save_results, callback_log=callback_log)
+        par_dict['net_avg_decisions'].extend(results['net_avg'])
 
     # Save settings
     if len(imgs) > 0:
@@ -265,11 +555,186 @@ def segment_obj_indiv(path_scan, obj_name, str_channel, img_ext, new_size, model
         json.dump(par_dict, fp, indent=4, sort_keys=True)
         fp.close()
 
+    if cache:
+        cache.log_stats()
+
     log_message(f'\n BATCH SEGMENTATION finished', callback_fun=callback_log)
 
 
-# Function to load and segment cells and nuclei images individually 
-def segment_cells_nuclei_indiv(path_scan, str_channels, img_ext, new_size, model_types, diameters, net_avg, resample, path_save, input_subfolder=None, callback_log=None, callback_status=None, callback_progress=None): 
+# Function to load and segment objects in z-stacks
+def segment_obj_stack(path_scan, obj_name, str_channel, img_ext, new_size, model_type, diameter, net_avg, resample, path_save, stitch_threshold=0.25, input_subfolder=None, postprocess=None, adaptive_threshold=0.2, cache_dir=None, cache_size_gb=10, callback_log=None, callback_status=None, callback_progress=None):
+    """ Will recursively search folder for z-stacks to be analyzed. All planes of a stack
+    are segmented in one call, and resulting 2D masks stitched to one 3D label image,
+    which is saved as a single tif file.
+
+    Parameters
+    ----------
+    path_scan : pathlib Path object
+        Path to scan for z-stacks.
+    obj_name : str
+        Name of the segmented object, e.g. 'nuclei'.
+    str_channel : str
+        Unique string to identify the stacks.
+    img_ext : str
+        Image extension, e.g. '.tif'.
+    new_size : tuple
+        Defines resizing of each z-plane. If two elements, new size of plane. If one element, resizing factor.
+        If emtpy, no resizing.
+    model_type : str
+        CellPose model, 'cyto' or 'nuclei'.
+    diameter : int
+        Typical diameter of the object.
+    path_save : pathlib object or string
+        Path to save results,
+        - If Pathlib object, then this absolute path is used.
+        - If 'string' a replacement operation on the provided name of the data path will be applied (see create_output_path).
+    stitch_threshold : float
+        Minimum intersection over union to link objects in adjacent planes, by default 0.25.
+    input_subfolder : str
+        Name of subfolder that contains results. If specified ONLY files in this folder will be processed.
+    postprocess : dict, optional
+        Parameters for post-processing of the masks (see utils_masks.postprocess_mask), e.g.
+        {'min_size': 50, 'remove_border': True, 'fill_holes': True}. Applied before masks are saved
+        and resized. By default None, no post-processing.
+    adaptive_threshold : float, optional
+        Only used if net_avg is 'adaptive': images with a mean flow error above this threshold (or without objects)
+        are segmented again with net_avg (see model_eval). Decisions for each image are saved in the
+        segmentation settings. By default 0.2.
+    cache_dir : pathlib Path object or str, optional
+        Folder of an on-disk cache of CellPose results (see utils_cache.MaskCache). Images already segmented with
+        identical parameters are loaded from the cache instead of being segmented again. Can be shared between
+        users and processes. By default None, no cache.
+    cache_size_gb : float, optional
+        Maximum size of the cache in GB, least recently used results are removed. By default 10.
+    callback_log : [type], optional
+        [description], by default None
+    callback_status : [type], optional
+        [description], by default None
+    callback_progress : [type], optional
+        [description], by default None
+    """
+
+    # Print all input parameters
+    par_dict = locals()
+    par_dict = clean_par_dict(par_dict)
+    log_message(f"Function (segment_obj_stack) called with: {str(par_dict)} ", callback_fun=callback_log)
+    par_dict['net_avg_decisions'] = []
+
+    cache = MaskCache(cache_dir, max_size=cache_size_gb*1024**3, callback_log=callback_log) if cache_dir else None
+
+    # Configurations
+    config = {'model_type': model_type,
+              'diameter': diameter,
+              'net_avg': net_avg,
+              'resample': resample,
+              'stitch_threshold': stitch_threshold,
+              'postprocess': postprocess,
+              'adaptive_threshold': adaptive_threshold,
+              'cache': cache}
+
+    channels = [0, 1]
+
+    # Use provided absolute user-path to save images.
+    if isinstance(path_save, pathlib.PurePath):
+        path_save_results = path_save
+        if not path_save_results.is_dir():
+            path_save_results.mkdir(parents=True)
+
+    else:
+        path_save_str_replace = path_save
+
+    if not path_scan.is_dir():
+        log_message(f'Path {path_scan} does not exist.', callback_fun=callback_log)
+        return
+
+    # Search for file to be analyzed
+    log_message(f'\nLoading z-stacks and segment them on the fly', callback_fun=callback_log)
+    files_proc = []
+    for path_img in path_scan.rglob(f'*{str_channel}*{img_ext}'):
+        if input_subfolder:
+            if path_img.parts[-2] == input_subfolder:
+                files_proc.append(path_img)
+        else:
+            files_proc.append(path_img)
+    n_imgs = len(files_proc)
+
+    if n_imgs == 0:
+        log_message(f'NO IMAGES FOUND. Check your settings.', callback_fun=callback_log)
+        return
+
+    # Process files
+    n_processed = 0
+    for idx, path_img in enumerate(files_proc):
+
+        log_message(f'Segmenting z-stack : {path_img.name}', callback_fun=callback_log)
+
+        if callback_status:
+            callback_status(f'Segmenting z-stack : {path_img.name}')
+
+        if callback_progress:
+            progress = float((idx+1)/n_imgs)
+            callback_progress(progress)
+
+        # Read stack
+        img = imread(str(path_img))
+        if img.ndim != 3:
+            log_message(f'\nERROR\n  Input image has to be 3D. Current image is {img.ndim}D', callback_fun=callback_log)
+            continue
+
+        size_orginal = img.shape[1:]
+
+        # Resize: new size of this stack
+        new_size_stack = new_size
+        if new_size:
+            import cv2
+
+            # New size can also be defined as a scalar factor
+            if len(new_size) == 1:
+                scale_factor = new_size[0]
+                new_size_stack = tuple(int(ti/scale_factor) for ti in size_orginal)
+
+        # Prepare individual planes
+        imgs = []
+        for img_plane in img:
+
+            if new_size_stack:
+                # IMPORTANT: CV2 resize is defined as (width, height)
+                dsize = (new_size_stack[1], new_size_stack[0])
+                img_plane = cv2.resize(img_plane, dsize)
+
+            img_zeros = np.zeros(img_plane.shape)
+            imgs.append(np.dstack([img_zeros, img_zeros, img_plane]))
+
+        # >>> Call function for prediction
+        data = {'imgs': imgs,
+                'file_name': path_img,
+                'channels': channels,
+                'obj_name': obj_name,
+                'size_orginal': size_orginal,
+                'new_size': new_size_stack}
+
+        # Create new output path if specified
+        if not isinstance(path_save, pathlib.PurePath):
+            path_save_results = create_output_path(path_img.parent, path_save_str_replace, subfolder='', create_path=True)
+
+        results = cellpose_predict_stack(data, config, path_save=path_save_results, callback_log=callback_log)
+        par_dict['net_avg_decisions'].extend(results['net_avg'])
+        n_processed += 1
+
+    # Save settings
+    if n_processed > 0:
+        fp = open(str(path_save_results / f'segmentation_settings__{obj_name}.json'), "w")
+        json.dump(par_dict, fp, indent=4, sort_keys=True)
+        fp.close()
+
+    if cache:
+        cache.log_stats()
+
+    log_message(f'\n BATCH SEGMENTATION finished', callback_fun=callback_log)
+
+
+# Function to load and segment cells and nuclei images individually
+def segment_cells_nuclei_indiv(path_scan, str_channels, img_ext, new_size, model_types, diameters, net_avg, resample, path_save, input_subfolder=None, postprocess=None, match_nuclei=False, save_cytoplasm=False, adaptive_threshold=0.2, cache_dir=None, cache_size_gb=10, callback_log=None, callback_status=None, callback_progress=None): 
     """[summary] segment cells and nuclei in bulk, e.g. first all images are loaded and then segmented. 
     TODO: specify parameters
     Parameters
@@ -292,6 +757,25 @@ def segment_cells_nuclei_indiv(path_scan, str_channels, img_ext, new_size, model
         - If Pathlib object, then this absolute path is used.
         - If 'string' a replacement operation on the provided name of the data path will be applied (see create_output_path).
           And results will be stored in subfolder 'segmentation-input'
+    postprocess : tuple of dicts, optional
+        Parameters for post-processing of the masks of cells and nuclei (see utils_masks.postprocess_mask), e.g.
+        ({'min_size': 200, 'remove_border': True}, {'min_size': 50, 'fill_holes': True}). Either element
+        can be None. Applied before masks are saved and resized. By default None, no post-processing.
+    adaptive_threshold : float, optional
+        Only used if net_avg is 'adaptive': images with a mean flow error above this threshold (or without objects)
+        are segmented again with net_avg (see model_eval). Decisions for each image are saved in the
+        segmentation settings. By default 0.2.
+    cache_dir : pathlib Path object or str, optional
+        Folder of an on-disk cache of CellPose results (see utils_cache.MaskCache). Images already segmented with
+        identical parameters are loaded from the cache instead of being segmented again. Can be shared between
+        users and processes. By default None, no cache.
+    cache_size_gb : float, optional
+        Maximum size of the cache in GB, least recently used results are removed. By default 10.
+    match_nuclei : bool, optional
+        Assign nuclei to cells, and save a table with the assignment for each cell (see
+        utils_masks.save_cells_nuclei_matching). By default False.
+    save_cytoplasm : bool, optional
+        When nuclei are assigned to cells, also save a mask of the cytoplasm. By default False.
     callback_log : [type], optional
         [description], by default None
     callback_status : [type], optional
@@ -303,11 +787,15 @@ def segment_cells_nuclei_indiv(path_scan, str_channels, img_ext, new_size, model
     par_dict = locals()
     par_dict = clean_par_dict(par_dict)
     log_message(f"Function (segment_obj_indiv) called with: {str(par_dict)} ", callback_fun=callback_log)
+    par_dict['net_avg_decisions'] = []
+
+    cache = MaskCache(cache_dir, max_size=cache_size_gb*1024**3, callback_log=callback_log) if cache_dir else None
 
     # Get parameters
     (str_cyto, str_nuclei) = str_channels
     (diameter_cells, diameter_nuclei) = diameters
     (model_type_cells, model_type_nuclei) = model_types
+    (postprocess_cells, postprocess_nuclei) = postprocess if postprocess else (None, None)
 
     # Use provided absolute user-path to save images.
     if isinstance(path_save, pathlib.PurePath):
@@ -322,12 +810,18 @@ def segment_cells_nuclei_indiv(path_scan, str_channels, img_ext, new_size, model
     config_nuclei = {'model_type': model_type_nuclei,
                      'diameter': diameter_nuclei,
                      'net_avg': net_avg,
-                     'resample': resample}
+                     'resample': resample,
+                     'postprocess': postprocess_nuclei,
+                     'adaptive_threshold': adaptive_threshold,
+                     'cache': cache}
 
     config_cyto = {'model_type': model_type_cells,
                    'diameter': diameter_cells,
                    'net_avg': net_avg,
-                   'resample': resample}
+                   'resample': resample,
+                   'postprocess': postprocess_cells,
+                   'adaptive_threshold': adaptive_threshold,
+                   'cache': cache}
 
     channels_cyto = [1, 3]
     channels_nuclei = [0, 1]
@@ -378,12 +872,12 @@ def segment_cells_nuclei_indiv(path_scan, str_channels, img_ext, new_size, model
             continue
 
         # Read images
-        img_cyto = io.imread(str(path_cyto))
+        img_cyto = imread(str(path_cyto))
         if img_cyto.ndim != 2:
             log_message(f'\nERROR\n  Input image of cell has to be 2D. Current image is {img_cyto.ndim}D', callback_fun=callback_log)
             continue
 
-        img_nuclei = io.imread(str(path_nuclei))
+        img_nuclei = imread(str(path_nuclei))
         if img_nuclei.ndim != 2:
             log_message(f'\nERROR\n  Input image of cell has to be 2D. Current image is {img_nuclei.ndim}D', callback_fun=callback_log)
             continue
@@ -393,6 +887,7 @@ def segment_cells_nuclei_indiv(path_scan, str_channels, img_ext, new_size, model
 
         # Resize
         if new_size:
+            import cv2
 
             # New size can also be defined as a scalar factor
             if len(new_size) == 1:
@@ -430,7 +925,8 @@ def segment_cells_nuclei_indiv(path_scan, str_channels, img_ext, new_size, model
                      'channels': channels_cyto,
                      'obj_name': 'cells'}
 
-        cellpose_predict(data_cyto, config_cyto, path_save=path_save_results, callback_log=callback_log)
+        results_cyto = cellpose_predict(data_cyto, config_cyto, path_save=path_save_results, callback_log=callback_log)
+        par_dict['net_avg_decisions'].extend(results_cyto['net_avg'])
 
         # >>> Call function for prediction of nuclei
         data_nuclei = {'imgs': imgs_nuclei,
@@ -440,7 +936,14 @@ def segment_cells_nuclei_indiv(path_scan, str_channels, img_ext, new_size, model
                        'sizes_orginal': sizes_orginal,
                        'new_size': new_size}
 
-        cellpose_predict(data_nuclei, config_nuclei, path_save=path_save_results, callback_log=callback_log)
+        results_nuclei = cellpose_predict(data_nuclei, config_nuclei, path_save=path_save_results, callback_log=callback_log)
+        par_dict['net_avg_decisions'].extend(results_nuclei['net_avg'])
+
+        # >>> Assign nuclei to cells
+        if match_nuclei:
+            save_cells_nuclei_matching(results_cyto['masks'][0], results_nuclei['masks'][0],
+                                       path_save=path_save_results, name_base=path_cyto.stem,
+                                       save_cytoplasm=save_cytoplasm, callback_log=callback_log)
 
     # Save settings
     if len(imgs_cyto) > 0:
@@ -448,10 +951,13 @@ def segment_cells_nuclei_indiv(path_scan, str_channels, img_ext, new_size, model
         json.dump(par_dict, fp, indent=4, sort_keys=True)
         fp.close()
 
+    if cache:
+        cache.log_stats()
+
     log_message(f'\n BATCH SEGMENTATION finished', callback_fun=callback_log)
 
 
-def resize_mask(mask_small, size_orginal):
+def resize_mask(mask_small, size_orginal, dtype='uint16'):
     """ Resize a label image.
     Parameters
     ----------
@@ -459,13 +965,17 @@ def resize_mask(mask_small, size_orginal):
         [description]
     size_orginal : [type]
         [description]
+    dtype : str
+        Data type of the resized label image, by default 'uint16'.
     Returns
     -------
     [type]
         [description]
     """
 
-    mask_full = np.zeros(size_orginal).astype('uint16')
+    import cv2
+
+    mask_full = np.zeros(size_orginal).astype(dtype)
     maski_template = np.zeros(mask_small.shape).astype('uint8')
 
     ind_objs = np.unique(mask_small)
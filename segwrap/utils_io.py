@@ -0,0 +1,58 @@
+# Imports
+import os
+
+
+# Lightweight image I/O, heavy libraries are only imported when needed
+def imread(filename):
+    """ Read an image. Tif files are read with tifffile, other formats with OpenCV.
+    Behaves like cellpose.io.imread, without importing CellPose (and torch).
+
+    Parameters
+    ----------
+    filename : str or pathlib Path object
+        Image to read.
+
+    Returns
+    -------
+    np array
+        Image. Color images are returned as RGB.
+    """
+    filename = str(filename)
+    ext = os.path.splitext(filename)[-1].lower()
+
+    if ext in ('.tif', '.tiff'):
+        import tifffile
+        return tifffile.imread(filename)
+
+    import cv2
+    img = cv2.imread(filename, cv2.IMREAD_UNCHANGED)
+    if img is None:
+        raise IOError(f'Could not read image: {filename}')
+    if img.ndim > 2:
+        img = img[..., [2, 1, 0]]
+    return img
+
+
+def imsave(filename, arr):
+    """ Save an image. Tif files are saved with tifffile, other formats with OpenCV.
+    Behaves like cellpose.io.imsave, without importing CellPose (and torch).
+
+    Parameters
+    ----------
+    filename : str or pathlib Path object
+        File name to save image.
+    arr : np array
+        Image to save. Color images are expected as RGB.
+    """
+    filename = str(filename)
+    ext = os.path.splitext(filename)[-1].lower()
+
+    if ext in ('.tif', '.tiff'):
+        import tifffile
+        tifffile.imwrite(filename, arr)
+        return
+
+    import cv2
+    if arr.ndim > 2:
+        arr = cv2.cvtColor(arr, cv2.COLOR_RGB2BGR)
+    cv2.imwrite(filename, arr)
@@ -1,14 +1,358 @@
 # Imports
-from cellpose.io import imread, imsave
 import numpy as np
-from tqdm import tqdm
 from scipy import ndimage
+from scipy import sparse
 import pathlib
+import csv
+from concurrent.futures import ProcessPoolExecutor
 
 from segwrap.utils_general import log_message, create_output_path
+from segwrap.utils_io import imread, imsave
+
+
+# Overlap between two label images
+def label_overlap(labels_a, labels_b):
+    """ Count the overlap between all pairs of objects in two label images of identical shape.
+
+    Paired labels are accumulated in a single pass over the pixels, cost is hence linear
+    in the number of pixels and does not depend on the number of objects.
+
+    Parameters
+    ----------
+    labels_a : np array
+        First label image.
+    labels_b : np array
+        Second label image.
+
+    Returns
+    -------
+    scipy sparse csr_matrix
+        Element (i, j) is the number of pixels with label i in labels_a and label j in labels_b.
+        Background (label 0) is not counted.
+    """
+    labels_a = labels_a.ravel()
+    labels_b = labels_b.ravel()
+
+    ind_fg = (labels_a > 0) & (labels_b > 0)
+    shape = (int(labels_a.max()) + 1, int(labels_b.max()) + 1)
+
+    # Duplicate entries are summed when converting to csr
+    overlap = sparse.coo_matrix((np.ones(np.count_nonzero(ind_fg), dtype=np.int64),
+                                 (labels_a[ind_fg], labels_b[ind_fg])), shape=shape)
+
+    return overlap.tocsr()
+
+
+def _argmax_per_group(groups, values):
+    """ Indices of the element with the largest value in each group. Ties are resolved
+    by taking the first element."""
+    order = np.lexsort((-values, groups))
+    _, ind_first = np.unique(groups[order], return_index=True)
+    return order[ind_first]
+
+
+# Stitch 2D label images along z
+def stitch_masks_3d(masks, stitch_threshold=0.25):
+    """ Stitch independently segmented 2D label images to one 3D label volume.
+
+    Objects in a plane are linked to the object in the previous (stitched) plane with which
+    they have the largest intersection over union (IoU). Links are one-to-one: if several objects
+    match the same previous object, only the one with the largest IoU inherits its label.
+    Objects without a match above the threshold obtain a new label.
+
+    Parameters
+    ----------
+    masks : list of np arrays or 3D np array
+        2D label images, first dimension is z.
+    stitch_threshold : float
+        Minimum IoU to link two objects in adjacent planes.
+
+    Returns
+    -------
+    np array
+        3D label image (uint32).
+    """
+    if len(masks) == 0:
+        return np.zeros((0, 0, 0), dtype=np.uint32)
+
+    masks_3d = np.zeros((len(masks),) + masks[0].shape, dtype=np.uint32)
+    masks_3d[0] = masks[0]
+    label_max = int(masks_3d[0].max())
+
+    for i_z in range(1, len(masks)):
+        mask_prev = masks_3d[i_z-1]
+        mask_curr = np.asarray(masks[i_z])
+
+        n_curr = int(mask_curr.max())
+        if n_curr == 0:
+            continue
+
+        # Intersection over union of all pairs of objects
+        overlap = label_overlap(mask_prev, mask_curr).tocoo()
+        area_prev = np.bincount(mask_prev.ravel(), minlength=overlap.shape[0])
+        area_curr = np.bincount(mask_curr.ravel(), minlength=overlap.shape[1])
+        iou = overlap.data / (area_prev[overlap.row] + area_curr[overlap.col] - overlap.data)
+
+        # Candidate links above threshold. One-to-one: for each previous object keep only
+        # the best current object, then for each current object the best remaining previous object.
+        ind_cand = (iou >= stitch_threshold) & (overlap.row > 0)
+        label_prev, label_curr, iou = overlap.row[ind_cand], overlap.col[ind_cand], iou[ind_cand]
+
+        ind_keep = _argmax_per_group(label_prev, iou)
+        label_prev, label_curr, iou = label_prev[ind_keep], label_curr[ind_keep], iou[ind_keep]
+
+        ind_keep = _argmax_per_group(label_curr, iou)
+        label_prev, label_curr = label_prev[ind_keep], label_curr[ind_keep]
+
+        # Lookup table: matched objects inherit label, others get a new one
+        lut = np.zeros(n_curr + 1, dtype=np.uint32)
+        lut[label_curr] = label_prev
+        ind_match = lut > 0
+
+        ind_new = np.flatnonzero(~ind_match & (area_curr > 0))
+        ind_new = ind_new[ind_new > 0]
+        lut[ind_new] = np.arange(label_max + 1, label_max + 1 + ind_new.size)
+        label_max += ind_new.size
+
+        masks_3d[i_z] = lut[mask_curr]
+
+    return masks_3d
+
+
+# Relabel label image sequentially
+def relabel_sequential(mask):
+    """ Relabel a label image such that labels are 1...N. Uses a lookup table, cost
+    is linear in the number of pixels.
+
+    Parameters
+    ----------
+    mask : np array
+        Label image.
+
+    Returns
+    -------
+    np array
+        Relabeled label image with same dtype as input.
+    """
+    present = np.zeros(int(mask.max()) + 1, dtype=bool)
+    present[mask.ravel()] = True
+    present[0] = False
+
+    lut = (np.cumsum(present) * present).astype(mask.dtype)
+
+    return lut[mask]
+
+
+# Post-processing of label image
+def postprocess_mask(mask, min_size=None, remove_border=False, fill_holes=False, relabel=True):
+    """ Post-process a 2D label image, e.g. as obtained from CellPose.
+    All steps use either a lookup table, bincount or ndimage.find_objects, the
+    cost hence scales with the number of pixels and not the number of objects.
+
+    Parameters
+    ----------
+    mask : np array
+        Label image.
+    min_size : int, optional
+        Objects with fewer pixels will be removed, by default None.
+    remove_border : bool, optional
+        Remove objects touching the image border, by default False.
+    fill_holes : bool, optional
+        Fill holes in objects, by default False.
+    relabel : bool, optional
+        Relabel objects sequentially, by default True.
+
+    Returns
+    -------
+    np array
+        Processed label image.
+    """
+    mask = np.asarray(mask)
+    n_labels = int(mask.max())
+    if n_labels == 0:
+        return mask
+
+    # Lookup table to remove objects
+    lut = np.arange(n_labels + 1, dtype=mask.dtype)
+
+    if min_size:
+        areas = np.bincount(mask.ravel(), minlength=n_labels + 1)
+        lut[areas < min_size] = 0
+
+    if remove_border:
+        labels_border = np.concatenate([mask[0, :], mask[-1, :], mask[:, 0], mask[:, -1]])
+        lut[labels_border] = 0
+
+    lut[0] = 0
+    mask = lut[mask]
+
+    # Fill holes within bounding box of each object
+    if fill_holes:
+        for label_obj, slice_obj in enumerate(ndimage.find_objects(mask), start=1):
+            if slice_obj is None:
+                continue
+            obj_filled = ndimage.binary_fill_holes(mask[slice_obj] == label_obj)
+            mask[slice_obj][obj_filled & (mask[slice_obj] == 0)] = label_obj
+
+    if relabel:
+        mask = relabel_sequential(mask)
+
+    return mask
+
+
+# Distance and index of closest object
+def closest_obj(img_labels, truncate_distance=None):
+    """ Calculate for each pixel the distance to, and the label of, the closest object.
+    Uses a single Euclidean distance transform for all objects.
+
+    Parameters
+    ----------
+    img_labels : np array
+        Label image.
+    truncate_distance : int, optional
+        Distance above which distances will be truncated. Pixels further away from any object
+        get the label 0.
+
+    Returns
+    -------
+    tuple of np arrays
+        Distance to closest object (float), label of closest object (same dtype as img_labels).
+    """
+    if not np.any(img_labels):
+        dist = np.full(img_labels.shape, np.inf if truncate_distance is None else truncate_distance)
+        return dist, np.zeros_like(img_labels)
+
+    dist, inds = ndimage.distance_transform_edt(img_labels == 0, return_indices=True)
+    ind_closest = img_labels[tuple(inds)]
+
+    if truncate_distance:
+        ind_far = dist > truncate_distance
+        dist[ind_far] = truncate_distance
+        ind_closest[ind_far] = 0
+
+    return dist, ind_closest
+
+
+def _open_labels_tiled(file_labels):
+    """ Open a tif label image for reading regions, without loading the entire image.
+    Returns the tifffile store (to be closed) and a zarr array."""
+    import tifffile
+    import zarr
+
+    store = tifffile.imread(str(file_labels), aszarr=True, series=0, level=0)
+    img_labels = zarr.open(store, mode='r')
+    return store, img_labels
+
+
+def _closest_obj_tile(file_labels, name_save_ind, name_save_dist, tile, halo, truncate_distance):
+    """ Process one tile of a label image (extended by a halo), and write results to the
+    memory-mapped output images."""
+    import tifffile
+
+    (y_start, y_end, x_start, x_end) = tile
+
+    store, img_labels = _open_labels_tiled(file_labels)
+    y_start_halo = max(y_start - halo, 0)
+    x_start_halo = max(x_start - halo, 0)
+    y_end_halo = min(y_end + halo, img_labels.shape[0])
+    x_end_halo = min(x_end + halo, img_labels.shape[1])
+    labels_tile = np.asarray(img_labels[y_start_halo:y_end_halo, x_start_halo:x_end_halo])
+    store.close()
+
+    dist, ind_closest = closest_obj(labels_tile, truncate_distance=truncate_distance)
+
+    # Crop halo
+    crop = (slice(y_start - y_start_halo, y_end - y_start_halo),
+            slice(x_start - x_start_halo, x_end - x_start_halo))
+
+    img_ind = tifffile.memmap(str(name_save_ind), mode='r+')
+    img_ind[y_start:y_end, x_start:x_end] = ind_closest[crop]
+    img_ind.flush()
+    del img_ind
+
+    img_dist = tifffile.memmap(str(name_save_dist), mode='r+')
+    img_dist[y_start:y_end, x_start:x_end] = dist[crop].astype(img_dist.dtype)
+    img_dist.flush()
+    del img_dist
+
+
+def closest_obj_blockwise(file_labels, name_save_ind, name_save_dist, truncate_distance, block_size=2048, n_workers=1, callback_log=None):
+    """ Calculate distance to, and label of, the closest object for large label images.
+    The label image is processed in tiles, each extended by a halo of size truncate_distance,
+    which guarantees results identical to closest_obj on the entire image. Tiles are read
+    directly from the file, and results are written tile by tile to uncompressed tif files,
+    memory usage is hence bounded by the tile size.
+
+    Parameters
+    ----------
+    file_labels : pathlib Path object
+        Label image, has to be a tif file (tiled, striped, compressed or not), which can be read region by region.
+    name_save_ind : pathlib Path object
+        Tif file to save label of closest object.
+    name_save_dist : pathlib Path object
+        Tif file to save distance to closest object (uint16).
+    truncate_distance : int
+        Distance above which distances will be truncated. Pixels further away from any object
+        get the label 0.
+    block_size : int
+        Size of tiles, by default 2048.
+    n_workers : int
+        Number of processes to process tiles in parallel, by default 1.
+    callback_log : callback, optional
+        Callback function to provide function log. If none, print will be used.
+
+    Returns
+    -------
+    bool
+        True if the label image could be processed.
+    """
+    import tifffile
+
+    file_labels = pathlib.Path(file_labels)
+
+    # Only tif files can be read region by region
+    if file_labels.suffix.lower() not in ('.tif', '.tiff'):
+        log_message(f' Blockwise processing requires tif label images, can not read {file_labels.name} region by region.', callback_fun=callback_log)
+        return False
+
+    store, img_labels = _open_labels_tiled(file_labels)
+    shape = img_labels.shape
+    dtype_ind = img_labels.dtype
+    store.close()
+
+    if len(shape) != 2:
+        log_message(f' Blockwise processing requires 2D label images, image has shape {shape}.', callback_fun=callback_log)
+        return False
+
+    # Create output images
+    for name_save, dtype in ((name_save_ind, dtype_ind), (name_save_dist, 'uint16')):
+        img_out = tifffile.memmap(str(name_save), shape=shape, dtype=dtype)
+        img_out.flush()
+        del img_out
+
+    # Tiles
+    halo = int(np.ceil(truncate_distance))
+    tiles = [(y_start, min(y_start + block_size, shape[0]), x_start, min(x_start + block_size, shape[1]))
+             for y_start in range(0, shape[0], block_size)
+             for x_start in range(0, shape[1], block_size)]
+
+    log_message(f' Processing {len(tiles)} tiles of size {block_size} (halo {halo}) with {n_workers} worker(s).', callback_fun=callback_log)
+
+    args = (file_labels, name_save_ind, name_save_dist)
+    if n_workers > 1:
+        with ProcessPoolExecutor(max_workers=n_workers) as executor:
+            futures = [executor.submit(_closest_obj_tile, *args, tile, halo, truncate_distance) for tile in tiles]
+            for future in futures:
+                future.result()
+    else:
+        for tile in tiles:
+            _closest_obj_tile(*args, tile, halo, truncate_distance)
+
+    return True
+
 
 # Calculate images summarizing distance to objects
-def create_img_closest_obj(path_scan, str_label, strs_save, path_save=None, search_recursive=False, truncate_distance=None, callback_log=None, callback_status=None, callback_progress=None):
+def create_img_closest_obj(path_scan, str_label, strs_save, path_save=None, search_recursive=False, truncate_distance=None, block_size=None, n_workers=1, callback_log=None, callback_status=None, callback_progress=None):
     """   Function to process label images and facilitate assignment to closest segmented object.
     Will create two 2D images with the same size as the label image. Pixel values in either image
     encode 
@@ -28,8 +372,15 @@ def create_img_closest_obj(path_scan, str_label, strs_save, path_save=None, sear
         - If Pathlib object, then this absolute path is used.
         - If 'string' a replacement operation path containing the analyzed mask will be applied (see create_output_path).
     truncate_distance : int
-        Distance above which distances will be truncated. Using a value of 255 has the advantage
-        that the saved image is 8bit and thus small.
+        Distance above which distances will be truncated. Pixels further away from any object
+        get the index 0.
+    block_size : int, optional
+        For label images that do not fit in memory: process the label image in tiles of this size
+        (see closest_obj_blockwise). Requires truncate_distance and tif label images. Results are identical,
+        but saved as tif files instead of png.
+        By default None, the entire image is processed at once.
+    n_workers : int, optional
+        Number of processes to process tiles in parallel, only used with block_size. By default 1.
     callback_log : callback, optional
         Callback function to provide function log. If none, print will be used.
         For more details see segwrap.utils_general.log_message
@@ -49,6 +400,10 @@ def create_img_closest_obj(path_scan, str_label, strs_save, path_save=None, sear
     else:
         path_save_str_replace = path_save
 
+    if block_size and not truncate_distance:
+        log_message(f'Blockwise processing requires truncate_distance.', callback_fun=callback_log)
+        return
+
     # Search files: recursively or not
     files_proc = []
     if search_recursive:
@@ -68,50 +423,154 @@ def create_img_closest_obj(path_scan, str_label, strs_save, path_save=None, sear
             path_save_results = create_output_path(file_label.parent, path_save_str_replace, subfolder=None, create_path=True)
             log_message(f'Results will be save here : {path_save_results}', callback_fun=callback_status)
 
-        # >>>> Read label image
-        img_labels = imread(file_label)
-        props = regionprops(img_labels)
-        labels = np.array([prop.label for prop in props])
-        n_objs = len(labels)
-
-        # Loop over all nuclei and create create distance map
-        log_message(f' Creating distance maps for {n_objs} objects. This can take a while ...', callback_fun=callback_log)
-        dist_mat = np.zeros((img_labels.shape[0], img_labels.shape[1], n_objs), dtype=np.uint16)
-        mask_fill_indiv = np.zeros((img_labels.shape[0], img_labels.shape[1], n_objs), dtype=np.uint16)
+        # >>> Process large images tile by tile
+        if block_size:
+            name_save_ind = path_save_results / f'{file_label.stem.replace(str_label, strs_save[0])}.tif'
+            name_save_dist = path_save_results / f'{file_label.stem.replace(str_label, strs_save[1])}.tif'
 
-        for indx, obj_int in enumerate(tqdm(np.nditer(labels), total=n_objs)):
+            if str(name_save_ind) == str(file_label) or str(name_save_dist) == str(file_label):
+                log_message(f'Names to save results could not be established: {name_save_ind}, {name_save_dist}', callback_fun=callback_log)
+                continue
 
-            # Create binary mask for current object and find contour
-            img_label_loop = np.zeros((img_labels.shape[0], img_labels.shape[1]))
-            img_label_loop[img_labels == obj_int] = 1
-            mask_fill_indiv[:, :, indx] = img_label_loop
+            closest_obj_blockwise(file_label, name_save_ind, name_save_dist, truncate_distance,
+                                  block_size=block_size, n_workers=n_workers, callback_log=callback_log)
+            continue
 
-            dist_obj = ndimage.distance_transform_edt(np.logical_not(img_label_loop))
-            if truncate_distance:
-                dist_obj[dist_obj > truncate_distance] = truncate_distance
-            dist_mat[:, :, indx] = dist_obj.astype(np.uint16)
-
-        # >>> Condense distmap in two matrixes: index and distance to closest object
-        dist_obj_ind_3D = np.argsort(dist_mat, axis=2)
-        dist_obj_dist_3D = np.take_along_axis(dist_mat, dist_obj_ind_3D, axis=2)
-
-        # For index: replace Python matrix index with actual index from label image
-        ind_obj_closest = np.zeros((img_labels.shape[0], img_labels.shape[1]))
-        dist_obj_ind_2D = np.copy(dist_obj_ind_3D[:, :, 0])
+        # >>>> Read label image
+        img_labels = imread(file_label)
+        n_objs = len(np.unique(img_labels)) - int(np.any(img_labels == 0))
 
-        for indx, obj_int in enumerate(np.nditer(labels)):
-            ind_obj_closest[dist_obj_ind_2D == indx] = obj_int
+        # Distance to, and label of, closest object
+        log_message(f' Creating distance maps for {n_objs} objects.', callback_fun=callback_log)
+        dist_obj_closest, ind_obj_closest = closest_obj(img_labels, truncate_distance=truncate_distance)
+        dist_obj_closest = np.minimum(dist_obj_closest, np.iinfo(np.uint16).max)
 
         # Save index of closest object
         name_save_ind = path_save_results / f'{file_label.stem.replace(str_label, strs_save[0])}.png'
         if str(name_save_ind) != str(file_label):
-            imsave(name_save_ind, ind_obj_closest.astype('uint16'), check_contrast=False)
+            imsave(name_save_ind, ind_obj_closest.astype('uint16'))
         else:
             log_message(f'Name to save index matrix could not be established: {name_save_ind}', callback_fun=callback_log)
 
         # Save distances to closest object
         name_save_dist = path_save_results / f'{file_label.stem.replace(str_label, strs_save[1])}.png'
         if str(name_save_dist) != str(file_label):
-            imsave(name_save_dist, dist_obj_dist_3D[:, :, 0].astype('uint16'), check_contrast=False)
+            imsave(name_save_dist, dist_obj_closest.astype('uint16'))
         else:
             log_message(f'Name to save index matrix could not be established: {name_save_dist}', callback_fun=callback_log)
+
+
+# Assign nuclei to cells
+def match_cells_nuclei(mask_cells, mask_nuclei, min_overlap=0.5):
+    """ Assign each nucleus to the cell it overlaps most with. The overlap between all cells
+    and nuclei is obtained in a single pass over the pixels (see label_overlap).
+
+    Parameters
+    ----------
+    mask_cells : np array
+        Label image of cells.
+    mask_nuclei : np array
+        Label image of nuclei, same size as mask_cells.
+    min_overlap : float
+        Minimum fraction of the nucleus area that has to be inside a cell, by default 0.5.
+
+    Returns
+    -------
+    dict
+        'nuclei_cell' : np array, cell label for each nucleus label (0 if not assigned).
+        'cells' : list of dicts, one per cell with keys 'cell_label', 'n_nuclei',
+                  'nuclei_labels' and 'flag' ('ok', 'no_nucleus' or 'multiple_nuclei').
+    """
+    mask_cells = np.asarray(mask_cells)
+    mask_nuclei = np.asarray(mask_nuclei)
+
+    # Overlap nuclei x cells
+    overlap = label_overlap(mask_nuclei, mask_cells)
+    area_nuclei = np.bincount(mask_nuclei.ravel(), minlength=overlap.shape[0])
+
+    # Cell with the largest overlap for each nucleus
+    cell_best = np.asarray(overlap.argmax(axis=1)).ravel()
+    overlap_best = np.asarray(overlap.max(axis=1).todense()).ravel()
+
+    frac_overlap = np.divide(overlap_best, area_nuclei, out=np.zeros(overlap_best.shape), where=area_nuclei > 0)
+    nuclei_cell = np.where(frac_overlap >= min_overlap, cell_best, 0)
+    nuclei_cell[0] = 0
+
+    # Number of assigned nuclei per cell
+    n_nuclei = np.bincount(nuclei_cell[nuclei_cell > 0], minlength=overlap.shape[1])
+    ind_nuclei = np.flatnonzero(nuclei_cell)
+    ind_nuclei = ind_nuclei[np.argsort(nuclei_cell[ind_nuclei], kind='stable')]
+    nuclei_per_cell = np.split(ind_nuclei, np.cumsum(n_nuclei)[:-1])
+
+    labels_cells = np.flatnonzero(np.bincount(mask_cells.ravel()))
+    labels_cells = labels_cells[labels_cells > 0]
+
+    cells = []
+    for label_cell in labels_cells:
+        n_nuc = int(n_nuclei[label_cell])
+        if n_nuc == 0:
+            flag = 'no_nucleus'
+        elif n_nuc > 1:
+            flag = 'multiple_nuclei'
+        else:
+            flag = 'ok'
+
+        cells.append({'cell_label': int(label_cell),
+                      'n_nuclei': n_nuc,
+                      'nuclei_labels': [int(i) for i in nuclei_per_cell[label_cell]],
+                      'flag': flag})
+
+    return {'nuclei_cell': nuclei_cell, 'cells': cells}
+
+
+# Save assignment of nuclei to cells
+def save_cells_nuclei_matching(mask_cells, mask_nuclei, path_save, name_base, min_overlap=0.5, save_cytoplasm=False, callback_log=None):
+    """ Assign nuclei to cells and save a table summarizing the assignment for each cell
+    ('{name_base}__cells_nuclei.csv'). Optionally, a mask of the cytoplasm
+    (cells without their assigned nuclei) is saved ('{name_base}__mask__cytoplasm.png').
+
+    Parameters
+    ----------
+    mask_cells : np array
+        Label image of cells.
+    mask_nuclei : np array
+        Label image of nuclei, same size as mask_cells.
+    path_save : pathlib Path object
+        Path to save results.
+    name_base : str
+        Base name of the saved files.
+    min_overlap : float
+        Minimum fraction of the nucleus area that has to be inside a cell, by default 0.5.
+    save_cytoplasm : bool
+        Save mask of the cytoplasm, by default False.
+    callback_log : callback, optional
+        Callback function to provide function log. If none, print will be used.
+
+    Returns
+    -------
+    dict
+        Results of the assignment, see match_cells_nuclei.
+    """
+    matching = match_cells_nuclei(mask_cells, mask_nuclei, min_overlap=min_overlap)
+    cells = matching['cells']
+
+    n_no_nucleus = sum(cell['flag'] == 'no_nucleus' for cell in cells)
+    n_multiple = sum(cell['flag'] == 'multiple_nuclei' for cell in cells)
+    log_message(f' Matched nuclei to {len(cells)} cells: {n_no_nucleus} without nucleus, {n_multiple} with multiple nuclei.', callback_fun=callback_log)
+
+    # Save table
+    name_table = path_save / f'{name_base}__cells_nuclei.csv'
+    with open(name_table, 'w', newline='') as fp:
+        writer = csv.writer(fp)
+        writer.writerow(['cell_label', 'n_nuclei', 'nuclei_labels', 'flag'])
+        for cell in cells:
+            writer.writerow([cell['cell_label'], cell['n_nuclei'], ';'.join(str(i) for i in cell['nuclei_labels']), cell['flag']])
+
+    # Save cytoplasm: remove pixels of nuclei assigned to the cell
+    if save_cytoplasm:
+        mask_cells = np.asarray(mask_cells)
+        mask_cyto = mask_cells.copy()
+        mask_cyto[(mask_nuclei > 0) & (matching['nuclei_cell'][mask_nuclei] == mask_cells)] = 0
+        imsave(str(path_save / f'{name_base}__mask__cytoplasm.png'), mask_cyto.astype('uint16'))
+
+    return matching
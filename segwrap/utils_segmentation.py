@@ -1,13 +1,150 @@
 # Imports
 import pathlib
 import json
-#from skimage.io import imread, imsave
-from cellpose.io import imread, imsave
+import numpy as np
 from segwrap.utils_general import log_message, create_output_path
+from segwrap.utils_io import imread, imsave
+
+
+def iter_planes(file_name):
+    """ Iterate over the planes of a (multichannel) z-stack stored as tif or OME-TIFF.
+    Planes are read one after the other, the whole stack is never loaded at once.
+
+    Parameters
+    ----------
+    file_name : str or pathlib Path object
+        Image to read.
+
+    Yields
+    ------
+    tuple
+        (index z-plane, index channel, plane as 2D numpy array)
+
+    Raises
+    ------
+    ValueError
+        If the image has other dimensions than z, channel, y and x.
+    """
+    import tifffile
+
+    with tifffile.TiffFile(str(file_name)) as tif:
+        series = tif.series[0]
+        axes = series.axes
+        shape = series.shape
+
+        if axes[-2:] != 'YX':
+            raise ValueError(f'Image has to have the last two dimensions YX, image has {axes}')
+
+        # Leading axes: only z and channel can have a size larger than 1
+        axes_lead = axes[:-2]
+        shape_lead = shape[:-2]
+        for axis, size in zip(axes_lead, shape_lead):
+            if size > 1 and axis not in 'ZC':
+                raise ValueError(f'Image can only have dimensions ZCYX, image has {axes} with shape {shape}')
+
+        def ind_axis(ind_lead, axis):
+            return int(ind_lead[axes_lead.index(axis)]) if axis in axes_lead else 0
+
+        pages = series.pages
+        n_planes = int(np.prod(shape_lead))
+
+        # Read plane by plane if each plane is stored as a page, otherwise read the entire series
+        if len(pages) == n_planes and all(page is not None for page in pages):
+            for ind_plane, page in enumerate(pages):
+                ind_lead = np.unravel_index(ind_plane, shape_lead)
+                yield ind_axis(ind_lead, 'Z'), ind_axis(ind_lead, 'C'), page.asarray()
+
+        else:
+            img = series.asarray().reshape((n_planes,) + tuple(shape[-2:]))
+            for ind_plane in range(n_planes):
+                ind_lead = np.unravel_index(ind_plane, shape_lead)
+                yield ind_axis(ind_lead, 'Z'), ind_axis(ind_lead, 'C'), img[ind_plane]
+
+
+def prepare_multichannel(file_proc, channel_names, name_base, path_save_results, projection_type, callback_log=None):
+    """ Create projections (or individual planes) of all channels of a multichannel z-stack
+    by reading the stack only once, plane by plane.
+
+    Parameters
+    ----------
+    file_proc : pathlib Path object
+        Multichannel z-stack to process.
+    channel_names : dict
+        Mapping of channel index (starting at 0) to channel name, e.g. {0: 'dapi', 1: 'cy3'}.
+        Channel names are appended to the name of the saved images. Channels not in this dictionary are ignored.
+    name_base : str
+        Base name of the saved images.
+    path_save_results : pathlib Path object
+        Path to save results.
+    projection_type : str
+        'mean', 'max', 'indiv' or 'stack', see folder_prepare_prediction.
+    callback_log : [type], optional
+        [description], by default None
+    """
+
+    channel_names = {int(ind): name for ind, name in channel_names.items()}
+    img_proj = {}
+    n_planes = {}
+    planes_stack = {}
+
+    for ind_z, ind_c, plane in iter_planes(file_proc):
+
+        if ind_c not in channel_names:
+            continue
+        name_channel = f'{name_base}_{channel_names[ind_c]}'
+
+        if projection_type == 'indiv':
+            path_save_indiv = path_save_results / name_channel
+            if not path_save_indiv.is_dir():
+                path_save_indiv.mkdir(parents=True)
+
+            name_save = path_save_indiv / f'{name_channel}_Z{str(ind_z+1).zfill(3)}.png'
+            if name_save.is_file():
+                log_message(f'File already exists. Will be overwritten {name_save}', callback_fun=callback_log)
+            imsave(str(name_save), plane)
+
+        elif projection_type == 'stack':
+            planes_stack.setdefault(ind_c, []).append(plane)
+
+        elif projection_type == 'mean':
+            if ind_c not in img_proj:
+                img_proj[ind_c] = np.zeros(plane.shape, dtype='float64')
+                n_planes[ind_c] = 0
+            img_proj[ind_c] += plane
+            n_planes[ind_c] += 1
+
+        elif projection_type == 'max':
+            if ind_c not in img_proj:
+                img_proj[ind_c] = plane.copy()
+            else:
+                np.maximum(img_proj[ind_c], plane, out=img_proj[ind_c])
+
+    # Save projections or stacks
+    for ind_c, name in channel_names.items():
+        name_channel = f'{name_base}_{name}'
+
+        if projection_type == 'stack' and ind_c in planes_stack:
+            name_save = path_save_results / f'{name_channel}.tif'
+            img_save = np.stack(planes_stack[ind_c])
+
+        elif projection_type in ('mean', 'max') and ind_c in img_proj:
+            name_save = path_save_results / f'{name_channel}.png'
+            if projection_type == 'mean':
+                img_proj[ind_c] /= n_planes[ind_c]
+            img_save = img_proj[ind_c].astype('uint16')
+
+        else:
+            if projection_type != 'indiv':
+                log_message(f'Channel {ind_c} ({name}) not found in image {file_proc}', callback_fun=callback_log)
+            continue
+
+        if name_save.is_file():
+            log_message(f'File already exists. Will be overwritten {name_save}', callback_fun=callback_log)
+        imsave(str(name_save), img_save)
 
 # Functions
 # TODO: allow multiple channel identifiers for segmentation of cells and nuclei (separate by ,)
-def folder_prepare_prediction(path_process, channel_ident, img_ext, path_save, projection_type, subfolder=None, search_recursive=False, callback_log=None, callback_status=None, callback_progress=None):
+def folder_prepare_prediction(path_process, channel_ident, img_ext, path_save, projection_type, subfolder=None, search_recursive=False, channel_names=None, callback_log=None, callback_status=None, callback_progress=None):
     """[summary]
 
     Parameters
@@ -23,12 +160,18 @@ def folder_prepare_prediction(path_process, channel_ident, img_ext, path_save, p
         - If Pathlib object, then this absolute path is used.
         - If 'string' a replacement operation on the provided name of the data path will be applied (see create_output_path).
           And results will be stored in subfolder 'segmentation-input'
-    projection_type : [type]
-        [description]
+    projection_type : str
+        'mean' or 'max' for projections, 'indiv' to save each z-plane as an individual image,
+        'stack' to save the z-stack as a single tif file (see utils_cellpose.segment_obj_stack).
     subfolder: str
         subfolder where data should be stored. Will only be used when string replacement for path is used. 
     search_recursive : bool
         Recursively search folder, default: false.
+    channel_names : dict, optional
+        For multichannel z-stacks (tif or OME-TIFF): mapping of channel index (starting at 0) to
+        channel name, e.g. {0: 'dapi', 1: 'cy3'}. All specified channels are obtained from a single read
+        of the stack, and saved with the channel name appended to the image name. By default None,
+        images contain only one channel.
     callback_log : [type], optional
         [description], by default None
     callback_status : [type], optional
@@ -77,6 +220,28 @@ def folder_prepare_prediction(path_process, channel_ident, img_ext, path_save, p
             log_message(f'Results will be save here : {path_save_results}', callback_fun=callback_status)
             path_save_settings = path_save_results       
 
+        # Multichannel stacks: process all channels from one read
+        if channel_names:
+            if name_base.endswith('.ome'):
+                name_base = name_base[:-len('.ome')]
+
+            img_properties = {"file_process": str(file_proc),
+                              "img_name": file_proc.name,
+                              "img_path": str(file_proc.parent),
+                              "channel_ident": channel_ident,
+                              "channel_names": {str(ind): name for ind, name in channel_names.items()},
+                              "projection_type": projection_type}
+
+            name_json = path_save_results / f'img-prop__{name_base}.json'
+            with open(name_json, 'w') as fp:
+                json.dump(img_properties, fp, sort_keys=True, indent=4)
+
+            try:
+                prepare_multichannel(file_proc, channel_names, name_base, path_save_results, projection_type, callback_log=callback_log)
+            except ValueError as err:
+                log_message(f'\nERROR\n  {err}', callback_fun=callback_log)
+            continue
+
         # Create subfolder when processing individual images
         if projection_type == 'indiv':
             path_save_indiv = path_save_results / name_base
@@ -109,6 +274,14 @@ def folder_prepare_prediction(path_process, channel_ident, img_ext, path_save, p
                     log_message(f'File already exists. Will be overwritten {name_save}', callback_fun=callback_log)
                 imsave(str(name_save), img[i, :, :])
 
+        elif projection_type == 'stack':
+
+            name_save = path_save_results / f'{name_base}.tif'
+
+            if name_save.is_file():
+                log_message(f'File already exists. Will be overwritten {name_save}', callback_fun=callback_log)
+            imsave(str(name_save), img)
+
         else:
 
             if projection_type == 'mean':
@@ -0,0 +1,89 @@
+""" Tests of model_eval with a stub returning values shaped like CellPose 0.6.5 Cellpose.eval,
+CellPose itself is hence not required."""
+import numpy as np
+import pytest
+
+from segwrap import utils_cellpose
+from segwrap.utils_cache import MaskCache
+
+
+class StubModel:
+    """ Returns one object per image. As CellPose, diams is a scalar if a diameter is specified,
+    and one estimated diameter per image otherwise."""
+
+    def __init__(self):
+        self.calls = []
+
+    def eval(self, imgs, diameter=None, channels=None, resample=False, net_avg=True):
+        self.calls.append({'n_imgs': len(imgs), 'net_avg': net_avg})
+        masks, flows = [], []
+        for img in imgs:
+            mask = np.zeros(img.shape, dtype='uint16')
+            mask[2:6, 2:6] = 1
+            masks.append(mask)
+            flows.append([np.zeros(img.shape + (3,), dtype='uint8'),
+                          np.zeros((2,) + img.shape, dtype='float32'),
+                          np.zeros(img.shape, dtype='float32')])
+        styles = np.zeros((len(imgs), 256), dtype='float32')
+        diams = diameter if diameter else np.full(len(imgs), 17.)
+        return masks, flows, styles, diams
+
+
+@pytest.fixture
+def model(monkeypatch):
+    model = StubModel()
+    monkeypatch.setattr(utils_cellpose, 'get_model', lambda model_type: model)
+    return model
+
+
+@pytest.fixture
+def imgs():
+    return [np.full((10, 10), idx, dtype='uint8') for idx in range(3)]
+
+
+def _config(net_avg=False, diameter=30, cache=None):
+    return {'model_type': 'nuclei', 'diameter': diameter, 'net_avg': net_avg,
+            'resample': False, 'adaptive_threshold': 0.2, 'cache': cache}
+
+
+def _model_eval(imgs, config):
+    return utils_cellpose.model_eval(imgs, config, [0, 0], [f'img_{idx}' for idx in range(len(imgs))])
+
+
+@pytest.mark.parametrize('diameter, diam_expected', [(30, 30.), (None, 17.)])
+def test_model_eval_plain(model, imgs, diameter, diam_expected):
+    masks, flows, diams, decisions = _model_eval(imgs, _config(diameter=diameter))
+
+    assert len(masks) == len(flows) == len(imgs)
+    assert diams == [diam_expected] * len(imgs)
+    assert decisions == []
+
+
+def test_model_eval_adaptive(model, imgs, monkeypatch):
+    # Flow error above threshold for the second image only
+    flow_errors = iter([0.1, 0.5, 0.1])
+    monkeypatch.setattr(utils_cellpose, 'image_flow_error', lambda mask, dP: next(flow_errors))
+
+    masks, flows, diams, decisions = _model_eval(imgs, _config(net_avg='adaptive'))
+
+    assert diams == [30.] * len(imgs)
+    assert [decision['net_avg'] for decision in decisions] == [False, True, False]
+    assert decisions[1]['reason'] == 'flow_error_above_threshold'
+    assert model.calls == [{'n_imgs': 3, 'net_avg': False}, {'n_imgs': 1, 'net_avg': True}]
+
+
+def test_model_eval_cache(model, imgs, tmp_path):
+    cache = MaskCache(tmp_path / 'cache')
+    config = _config(cache=cache)
+
+    masks, flows, diams, decisions = _model_eval(imgs, config)
+    assert cache.misses == len(imgs)
+    assert len(list((tmp_path / 'cache').glob('*/*.npz'))) == len(imgs)
+
+    # Second run is served from the cache
+    masks_cached, flows_cached, diams_cached, _ = _model_eval(imgs, config)
+    assert cache.hits == len(imgs)
+    assert len(model.calls) == 1
+    assert [float(diam) for diam in diams_cached] == diams
+    for mask, mask_cached in zip(masks, masks_cached):
+        np.testing.assert_array_equal(mask, mask_cached)